@@ -1,11 +1,15 @@
 """Miss Lisa Telegram Bot - Main bot implementation"""
 import asyncio
 import logging
+import signal
+import weakref
 from datetime import datetime
-from typing import Optional
+from itertools import islice
+from typing import Any, Dict, List, Optional, Sequence
 
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.constants import ParseMode
+from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from telegram.error import TelegramError
 
 from gemini_client import GeminiClient
@@ -20,49 +24,82 @@ class MissLisaBot:
         self.gemini_client = GeminiClient(gemini_api_key)
         self.conversation_manager = ConversationManager()
         
-        # Initialize Telegram application
-        self.application = Application.builder().token(telegram_token).build()
+        # Background tasks are referenced here so they aren't garbage collected
+        self._bg_tasks: set[asyncio.Task] = set()
+        # Users with a summary update in flight
+        self._summarizing: set[int] = set()
+        # Per-user locks so a user's memory updates land in message order
+        self._memory_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+        
+        # Initialize Telegram application; updates from different users are handled concurrently
+        self.application = (
+            Application.builder()
+            .token(telegram_token)
+            .concurrent_updates(True)
+            .build()
+        )
         
         # Add handlers
         self._setup_handlers()
         
     def _setup_handlers(self):
         """Setup bot command and message handlers"""
-        self.application.add_handler(CommandHandler("start", self.start_command))
-        self.application.add_handler(CommandHandler("help", self.help_command))
-        self.application.add_handler(CommandHandler("clear", self.clear_command))
-        self.application.add_handler(CommandHandler("profile", self.profile_command))
-        self.application.add_handler(CommandHandler("memory", self.memory_command))
-        
-        # Message handler for regular conversations
-        self.application.add_handler(MessageHandler(
-            filters.TEXT & ~filters.COMMAND, 
-            self.handle_message
-        ))
+        self._cmd_map = {
+            'start': self.start_command,
+            'help': self.help_command,
+            'clear': self.clear_command,
+            'profile': self.profile_command,
+            'memory': self.memory_command,
+        }
+        
+        # A single handler routes both commands and regular conversations; block=False
+        # runs each update in its own task so a slow Gemini call can't hold up others
+        self.application.add_handler(MessageHandler(filters.TEXT, self._dispatch, block=False))
         
         # Error handler
         self.application.add_error_handler(self.error_handler)
     
+    async def _dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Route a text message to its command handler or to handle_message"""
+        if not update.message or not update.message.text:
+            return
+        
+        text = update.message.text
+        if not text.startswith('/'):
+            await self.handle_message(update, context)
+            return
+        
+        # "/command@BotName args" - only answer commands addressed to this bot
+        words = text[1:].split(None, 1)
+        command, _, bot_name = (words[0] if words else '').partition('@')
+        if bot_name and bot_name.lower() != (context.bot.username or '').lower():
+            return
+        
+        # Unknown commands are ignored
+        handler = self._cmd_map.get(command.lower())
+        if handler is not None:
+            await handler(update, context)
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user_id = update.effective_user.id
         user_name = update.effective_user.first_name or "gorgeous"
         
         # Update user profile
-        self.conversation_manager.update_user_profile(user_id, user_name)
+        self.conversation_manager.ensure_user_profile(user_id, user_name)
         
         await update.message.reply_text(
-            Config.WELCOME_MESSAGE,
-            parse_mode='Markdown'
+            Config.WELCOME_MESSAGE_V2,
+            parse_mode=ParseMode.MARKDOWN_V2
         )
         
-        logger.info(f"User {user_id} ({user_name}) started the bot")
+        logger.info("User %s (%s) started the bot", user_id, user_name)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
         await update.message.reply_text(
-            Config.HELP_MESSAGE,
-            parse_mode='Markdown'
+            Config.HELP_MESSAGE_V2,
+            parse_mode=ParseMode.MARKDOWN_V2
         )
     
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -71,10 +108,11 @@ class MissLisaBot:
         
         # Clear conversation history
         self.conversation_manager.clear_conversation_history(user_id)
+        self.gemini_client.forget_chat(user_id)
         
         await update.message.reply_text(Config.PROFILE_CLEARED)
         
-        logger.info(f"User {user_id} cleared their conversation history")
+        logger.info("User %s cleared their conversation history", user_id)
     
     async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /profile command"""
@@ -111,51 +149,221 @@ class MissLisaBot:
                 return
             
             # Get conversation context
-            conversation_history = self.conversation_manager.get_conversation_history(user_id)
+            conversation_history = await self.conversation_manager.get_prompt_history(user_id)
             user_profile = self.conversation_manager.get_user_profile(user_id)
             
-            # Generate response using Gemini
-            bot_response = await self.gemini_client.generate_response(
-                message_text, 
-                conversation_history, 
-                user_profile
-            )
+            # Mention the memories most relevant to this message when there are more than fit
+            relevant_memories = None
+            if (Config.RANK_MEMORIES_BY_RELEVANCE and user_profile and
+                len(user_profile.get('memories') or ()) > Config.PROMPT_MEMORIES):
+                query = await self.gemini_client.embed([message_text])
+                if query is not None:
+                    relevant_memories = self.conversation_manager.get_relevant_memories(
+                        user_id, query[0], Config.PROMPT_MEMORIES
+                    )
             
-            # Send response
-            await update.message.reply_text(bot_response)
+            if Config.STREAM_RESPONSES:
+                # Show the reply as it's generated; memories are extracted separately
+                bot_response = await self._stream_reply(
+                    update, message_text, conversation_history, user_profile, relevant_memories, user_id
+                )
+                if bot_response is None:
+                    # A reply cut off partway isn't worth remembering
+                    return
+                await self._bookkeep(user_id, message_text, bot_response, user_name, None)
+                logger.info("Processed message from user %s: %s chars", user_id, len(message_text))
+                return
             
-            # Save conversation
-            self.conversation_manager.add_conversation_entry(
-                user_id, message_text, bot_response, user_name
+            # Generate the response and extract memories in one Gemini call
+            combined = await self.gemini_client.generate_response_with_memories(
+                message_text,
+                conversation_history,
+                user_profile,
+                relevant_memories,
+                chat_id=user_id
             )
             
-            # Extract and save memories asynchronously
-            asyncio.create_task(self._extract_and_save_memories(
-                user_id, message_text, bot_response
-            ))
+            if combined is not None:
+                bot_response, memories = combined
+            else:
+                # Fall back to a plain response with separate memory extraction
+                bot_response = await self.gemini_client.generate_response(
+                    message_text, 
+                    conversation_history, 
+                    user_profile,
+                    relevant_memories,
+                    chat_id=user_id
+                )
+                memories = None
             
-            # Auto cleanup memories for this user if needed
-            self.conversation_manager.auto_cleanup_memories_for_user(user_id)
+            # Send response while recording the turn
+            await asyncio.gather(
+                update.message.reply_text(bot_response),
+                self._bookkeep(user_id, message_text, bot_response, user_name, memories)
+            )
             
-            logger.info(f"Processed message from user {user_id}: {len(message_text)} chars")
+            logger.info("Processed message from user %s: %s chars", user_id, len(message_text))
             
         except Exception as e:
-            logger.error(f"Error handling message from user {user_id}: {e}")
+            logger.error("Error handling message from user %s: %s", user_id, e)
             await update.message.reply_text(Config.ERROR_MESSAGES['general_error'])
     
+    async def _stream_reply(self,
+                            update: Update,
+                            message_text: str,
+                            conversation_history: Sequence[Dict[str, Any]],
+                            user_profile: Optional[Dict[str, Any]],
+                            relevant_memories: Optional[List[Dict[str, Any]]],
+                            user_id: int) -> Optional[str]:
+        """Send a reply as it streams in, editing the message as text arrives
+        
+        Returns the full reply, or None if the stream broke partway through.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = []
+        sent = None
+        shown = ""
+        last_edit = 0.0
+        complete = True
+        
+        try:
+            async for chunk in self.gemini_client.generate_response_stream(
+                message_text, conversation_history, user_profile, relevant_memories, chat_id=user_id
+            ):
+                chunks.append(chunk)
+                text = "".join(chunks).strip()
+                if not text:
+                    continue
+                
+                if sent is None:
+                    sent = await update.message.reply_text(text)
+                    shown = text
+                    last_edit = loop.time()
+                elif loop.time() - last_edit >= Config.STREAM_EDIT_INTERVAL:
+                    # Telegram throttles message edits, so updates are spaced out
+                    try:
+                        await sent.edit_text(text)
+                        shown = text
+                    except TelegramError as e:
+                        logger.debug("Failed to update streamed reply: %s", e)
+                    last_edit = loop.time()
+        except TelegramError:
+            raise
+        except Exception as e:
+            # The stream only raises once some text has arrived; keep what was shown
+            logger.warning("Streamed reply to user %s was cut off: %s", user_id, e)
+            complete = False
+        
+        bot_response = "".join(chunks).strip() or Config.ERROR_MESSAGES['api_error']
+        if sent is None:
+            await update.message.reply_text(bot_response)
+        elif shown != bot_response:
+            try:
+                await sent.edit_text(bot_response)
+            except TelegramError as e:
+                logger.warning("Failed to finish streamed reply to user %s: %s", user_id, e)
+        return bot_response if complete else None
+    
+    async def _bookkeep(self,
+                        user_id: int,
+                        user_message: str,
+                        bot_response: str,
+                        user_name: str,
+                        memories: Optional[List[Dict[str, str]]]):
+        """Save a finished conversation turn
+        
+        Gathered with the reply so it runs once the send is waiting on the
+        network. It stays on the event loop because the conversation
+        manager isn't thread-safe.
+        """
+        # Save conversation
+        await self.conversation_manager.add_conversation_entry(
+            user_id, user_message, bot_response, user_name
+        )
+        
+        if memories is None:
+            # Extract and save memories asynchronously
+            self._spawn(self._extract_and_save_memories(
+                user_id, user_message, bot_response
+            ))
+        elif memories:
+            # Embedding them takes another API call, so save in the background
+            self._spawn(self._save_memories(user_id, memories))
+        
+        # Fold older turns into the running summary once enough have piled up
+        if user_id not in self._summarizing:
+            prompt_history = await self.conversation_manager.get_prompt_history(user_id)
+            if len(prompt_history) >= Config.SUMMARY_TRIGGER_TURNS:
+                self._summarizing.add(user_id)
+                self._spawn(self._summarize_history(
+                    user_id, list(islice(prompt_history, len(prompt_history) - Config.SUMMARY_KEEP_TURNS))
+                ))
+        
+        # Auto cleanup memories for this user if needed
+        self.conversation_manager.auto_cleanup_memories_for_user(user_id)
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+        return task
+    
+    async def _summarize_history(self, user_id: int, turns: List[Dict[str, Any]]):
+        """Replace older conversation turns with a running summary (async)"""
+        try:
+            profile = self.conversation_manager.get_user_profile(user_id)
+            summary = profile.get('summary') if profile else None
+            text = await self.gemini_client.summarize_history(
+                summary['text'] if summary else None, turns
+            )
+            if text:
+                await self.conversation_manager.set_summary(user_id, text, turns[-1]['timestamp'])
+        except Exception as e:
+            logger.error("Error summarizing conversation for user %s: %s", user_id, e)
+        finally:
+            self._summarizing.discard(user_id)
+    
+    def _memory_lock(self, user_id: int) -> asyncio.Lock:
+        """Get the lock serializing a user's memory updates"""
+        # Weakly held, so a user's lock goes away once no task is using it
+        lock = self._memory_locks.get(user_id)
+        if lock is None:
+            lock = self._memory_locks[user_id] = asyncio.Lock()
+        return lock
+    
     async def _extract_and_save_memories(self, user_id: int, user_message: str, bot_response: str):
         """Extract and save memories from conversation (async)"""
         try:
-            memories = await self.gemini_client.extract_memories(user_message, bot_response)
-            if memories:
-                self.conversation_manager.add_memories(user_id, memories)
-                logger.info(f"Extracted {len(memories)} memories for user {user_id}")
+            # Queued before waiting on the lock, so a burst of this user's
+            # messages can share one extraction call
+            extraction = asyncio.ensure_future(
+                self.gemini_client.extract_memories(user_message, bot_response, user_id)
+            )
+            async with self._memory_lock(user_id):
+                memories = await extraction
+                if memories:
+                    await self._store_memories(user_id, memories)
+        except Exception as e:
+            logger.error("Error extracting memories for user %s: %s", user_id, e)
+    
+    async def _save_memories(self, user_id: int, memories: List[Dict[str, str]]):
+        """Save memories that were extracted along with the reply (async)"""
+        try:
+            async with self._memory_lock(user_id):
+                await self._store_memories(user_id, memories)
         except Exception as e:
-            logger.error(f"Error extracting memories for user {user_id}: {e}")
+            logger.error("Error saving memories for user %s: %s", user_id, e)
+    
+    async def _store_memories(self, user_id: int, memories: List[Dict[str, str]]):
+        """Embed and save memories; the caller holds the user's memory lock"""
+        embeddings = await self.gemini_client.embed([m['content'] for m in memories])
+        self.conversation_manager.add_memories(user_id, memories, embeddings)
+        logger.info("Extracted %s memories for user %s", len(memories), user_id)
     
     async def error_handler(self, update: Optional[Update], context: ContextTypes.DEFAULT_TYPE):
         """Handle errors"""
-        logger.error(f"Update {update} caused error {context.error}")
+        logger.error("Update %s caused error %s", update, context.error)
         
         if update and update.effective_message:
             try:
@@ -169,50 +377,47 @@ class MissLisaBot:
         """Start the bot"""
         logger.info("Starting Miss Lisa Bot application...")
         
-        # Start cleanup task
-        asyncio.create_task(self._periodic_cleanup())
+        # Start conversation persistence and cleanup tasks
+        self.conversation_manager.start()
+        self._spawn(self._periodic_cleanup())
         
         # Start the bot
         await self.application.initialize()
         await self.application.start()
         await self.application.updater.start_polling(
+            timeout=Config.POLLING_TIMEOUT,  # Long polling: Telegram holds getUpdates open until updates arrive
+            poll_interval=0.0,
             allowed_updates=Update.ALL_TYPES,
             drop_pending_updates=True
         )
         
         logger.info("Miss Lisa Bot is now running...")
         
-        # Keep the bot running
-        try:
-            await self.application.updater.idle()
-        except AttributeError:
-            # For newer versions of python-telegram-bot
-            import signal
-            import sys
-            
-            def signal_handler(sig, frame):
-                logger.info("Bot stopped by signal")
-                sys.exit(0)
-            
-            signal.signal(signal.SIGINT, signal_handler)
-            signal.signal(signal.SIGTERM, signal_handler)
-            
-            # Keep running until interrupted
-            while True:
-                await asyncio.sleep(1)
+        # Run until SIGINT/SIGTERM, then fall through to the shutdown sequence
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows event loops don't support add_signal_handler
+                signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+        await stop.wait()
+        logger.info("Bot stopped by signal")
         
         # Cleanup on shutdown
         await self.application.updater.stop()
         await self.application.stop()
         await self.application.shutdown()
+        await self.conversation_manager.close()
     
     async def _periodic_cleanup(self):
         """Periodic cleanup of old conversations"""
         while True:
             try:
                 await asyncio.sleep(3600)  # Run every hour
-                self.conversation_manager.cleanup_old_conversations()
-                self.conversation_manager.cleanup_old_memories()
+                await self.conversation_manager.cleanup_old_conversations()
+                await self.conversation_manager.cleanup_old_memories()
                 logger.info("Completed periodic cleanup of conversations and memories")
             except Exception as e:
-                logger.error(f"Error in periodic cleanup: {e}")
+                logger.error("Error in periodic cleanup: %s", e)
@@ -1,10 +1,27 @@
 """Configuration settings for Miss Lisa Bot"""
 import os
+import re
+
+from telegram.helpers import escape_markdown
+
+_BOLD = re.compile(r'\*\*(.+?)\*\*')
+
+def _to_markdown_v2(text: str) -> str:
+    """Escape text for MarkdownV2, keeping **bold** spans bold"""
+    parts = []
+    last = 0
+    for match in _BOLD.finditer(text):
+        parts.append(escape_markdown(text[last:match.start()], version=2))
+        parts.append(f"*{escape_markdown(match.group(1), version=2)}*")
+        last = match.end()
+    parts.append(escape_markdown(text[last:], version=2))
+    return ''.join(parts)
 
 class Config:
     # Bot configuration
     BOT_NAME = "Miss Lisa"
     BOT_USERNAME = "@MissLisaBot"
+    POLLING_TIMEOUT = 25  # seconds to long-poll getUpdates
     
     # Rate limiting (requests per minute per user)
     RATE_LIMIT_REQUESTS = 10
@@ -14,11 +31,49 @@ class Config:
     MAX_CONVERSATION_HISTORY = 20
     MAX_USER_MEMORIES = 50
     CONVERSATION_CLEANUP_HOURS = 24
+    CLEANUP_CHUNK_SIZE = 256  # Users processed between event loop yields
+    PROMPT_MEMORIES = 3  # Memories mentioned in each prompt
+    # Rank memories against each message by embedding similarity instead of recency.
+    # Costs an embedding round trip before generation on every such message
+    RANK_MEMORIES_BY_RELEVANCE = False
+    SUMMARY_TRIGGER_TURNS = 16  # Unsummarized turns that trigger a summary update
+    SUMMARY_KEEP_TURNS = 6  # Recent turns kept verbatim when summarizing
+    MIN_MEMORY_MESSAGE_LENGTH = 15  # Shorter messages skip memory extraction
+    MEMORY_BATCH_SIZE = 16  # Memory extractions sent in one Gemini call
+    MEMORY_BATCH_INTERVAL = 0.25  # seconds to wait for more extractions to batch
+    
+    # Conversation persistence
+    DATABASE_PATH = os.getenv('LISA_DB_PATH', 'lisa.db')
+    CONVERSATION_CACHE_USERS = 1024  # Users whose history is kept in memory
+    DB_WRITE_BATCH_SIZE = 100
+    DB_WRITE_BATCH_INTERVAL = 0.05  # seconds
     
     # Gemini settings
     GEMINI_MODEL = "gemini-2.5-flash"
     MAX_RESPONSE_TOKENS = 800
     TEMPERATURE = 0.8
+    GEMINI_QPM = 1000  # Requests per minute allowed by the API quota
+    GEMINI_MAX_CONNECTIONS = 64
+    GEMINI_KEEPALIVE_CONNECTIONS = 32
+    GEMINI_KEEPALIVE_EXPIRY = 60.0  # seconds
+    # Streaming shows replies sooner, but gives up extracting memories in the same call
+    STREAM_RESPONSES = False
+    STREAM_EDIT_INTERVAL = 1.0  # seconds between edits of a streaming reply
+    
+    # Semantic response cache (shared across users for context-free turns)
+    EMBEDDING_MODEL = "gemini-embedding-001"
+    EMBEDDING_DIMENSIONS = 768
+    SEMANTIC_CACHE_SIZE = 2048
+    SEMANTIC_CACHE_THRESHOLD = 0.90  # Minimum cosine similarity for a hit
+    
+    # Per-chat cache of replies to repeated greetings
+    RESPONSE_CACHE_SIZE = 1024
+    RESPONSE_CACHE_TTL = 300  # seconds
+    
+    # Server-side caching of each chat's history
+    CONTEXT_CACHE_MIN_TURNS = 10  # Shorter histories are under Gemini's minimum cache size
+    CONTEXT_CACHE_REFRESH_TURNS = 6  # New turns before a chat's history cache is rebuilt
+    CONTEXT_CACHE_TTL = 600  # seconds
     
     # Miss Lisa's personality system instructions
     SYSTEM_INSTRUCTIONS = """You are Miss Lisa, a bold, confident, seductive woman who embraces romance and passion.
@@ -63,6 +118,10 @@ Whisper to me anytime, or try:
 
 I'm here whenever you need me, darling... 💋"""
 
+    # Escaped once at import time for parse_mode=MarkdownV2
+    WELCOME_MESSAGE_V2 = _to_markdown_v2(WELCOME_MESSAGE)
+    HELP_MESSAGE_V2 = _to_markdown_v2(HELP_MESSAGE)
+
     PROFILE_CLEARED = "Our slate is clean now, gorgeous... 😘 But I'm excited to discover you all over again 💖🌙"
     
     NO_PROFILE = "We're just getting started, aren't we? 😘 Talk to me more and I'll learn all your secrets... 💋🌶️"
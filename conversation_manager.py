@@ -1,133 +1,326 @@
 """Conversation and memory management for Miss Lisa Bot"""
-import json
+import asyncio
+import heapq
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+import time
+from collections import OrderedDict, defaultdict, deque
+from itertools import islice
+from typing import Dict, List, Any, Optional, Sequence, Tuple
+
+import numpy as np
+
 from config import Config
+from conversation_store import ConversationStore
 
 logger = logging.getLogger(__name__)
 
+# Display prefixes for each memory type
+_PROFILE_EMOJI = {
+    'interest': '✨', 'goal': '🎯', 'achievement': '🏆', 
+    'preference': '💫', 'desire': '💖', 'fantasy': '🌙',
+    'secret': '🔐', 'passion': '🔥', 'weakness': '💋'
+}
+
+_MEMORY_EMOJI = {
+    'interest': '✨ Interests', 'goal': '🎯 Goals', 'achievement': '🏆 Achievements',
+    'preference': '💫 Preferences', 'desire': '💖 Desires', 'fantasy': '🌙 Fantasies',
+    'secret': '🔐 Secrets', 'passion': '🔥 Passions', 'weakness': '💋 Weaknesses'
+}
+
 class ConversationManager:
-    def __init__(self):
-        # In-memory storage for user conversations and profiles
-        self.conversations: Dict[int, List[Dict[str, Any]]] = {}
+    def __init__(self, db_path: str = Config.DATABASE_PATH):
+        # Conversations persist in SQLite; recently active users' history is cached here
+        self.store = ConversationStore(db_path)
+        self.conversations: OrderedDict[int, deque] = OrderedDict()
+        # In-memory storage for user profiles
         self.user_profiles: Dict[int, Dict[str, Any]] = {}
-        self.user_rate_limits: Dict[int, List[datetime]] = {}
+        self.user_rate_limits: Dict[int, deque] = {}
+        # Min-heap of (last_interaction, user_id); stale entries are skipped lazily
+        self._lru_heap: List[Tuple[float, int]] = []
+    
+    @staticmethod
+    def _now() -> float:
+        """Current wall-clock time as a float; timestamps are only formatted on display"""
+        return time.time()
+    
+    @staticmethod
+    def _forget_memory(profile: Dict[str, Any], memory: Dict[str, Any]):
+        """Remove the oldest memory from the profile's dedup index and type buckets"""
+        profile['_memory_index'].discard(memory['content'].lower())
+        
+        # Being the oldest memory overall, it is also the oldest of its type
+        bucket = profile['_by_type'].get(memory['type'])
+        if bucket:
+            bucket.popleft()
+            if not bucket:
+                del profile['_by_type'][memory['type']]
+    
+    def _expire_memories(self, profile: Dict[str, Any], threshold: float) -> int:
+        """Drop memories recorded at or before the threshold, oldest first"""
+        # Memories are appended in time order, so expired ones sit at the left
+        memories = profile['memories']
+        removed = 0
+        while memories and memories[0]['timestamp'] <= threshold:
+            self._forget_memory(profile, memories.popleft())
+            removed += 1
+        if removed:
+            profile['_embedding_matrix'] = None
+        return removed
+    
+    def start(self):
+        """Start persisting conversations in the background"""
+        self.store.start()
+    
+    async def close(self):
+        """Flush pending conversation writes"""
+        await self.store.close()
+    
+    async def _history(self, user_id: int) -> deque:
+        """Get a user's cached history, loading it from the store on a miss"""
+        history = self.conversations.get(user_id)
+        if history is not None:
+            self.conversations.move_to_end(user_id)
+            return history
+        
+        # Cold read off the event loop; an indexed lookup of at most MAX_CONVERSATION_HISTORY rows
+        rows = await self.store.load(user_id, Config.MAX_CONVERSATION_HISTORY)
+        history = self.conversations.get(user_id)
+        if history is not None:
+            # Loaded or cleared by another handler during the read, which is more current
+            self.conversations.move_to_end(user_id)
+            return history
+        
+        history = deque(rows, maxlen=Config.MAX_CONVERSATION_HISTORY)
+        profile = self.user_profiles.get(user_id)
+        summary = profile.get('summary') if profile else None
+        if summary is not None and (not history or history[-1]['timestamp'] < summary['upto']):
+            # The summarized conversation was deleted from the store meanwhile
+            del profile['summary']
+        self.conversations[user_id] = history
+        if len(self.conversations) > Config.CONVERSATION_CACHE_USERS:
+            self.conversations.popitem(last=False)
+        return history
         
     def check_rate_limit(self, user_id: int) -> bool:
         """Check if user has exceeded rate limit"""
-        now = datetime.now()
+        # Ring buffer of monotonic request times; never holds more than the limit
+        requests = self.user_rate_limits.get(user_id)
+        if requests is None:
+            requests = deque(maxlen=Config.RATE_LIMIT_REQUESTS)
+            self.user_rate_limits[user_id] = requests
         
-        # Clean old requests
-        if user_id in self.user_rate_limits:
-            self.user_rate_limits[user_id] = [
-                req_time for req_time in self.user_rate_limits[user_id]
-                if now - req_time < timedelta(seconds=Config.RATE_LIMIT_WINDOW)
-            ]
-        else:
-            self.user_rate_limits[user_id] = []
+        now = time.monotonic()
+        
+        # Drop requests that fell out of the window
+        while requests and now - requests[0] >= Config.RATE_LIMIT_WINDOW:
+            requests.popleft()
         
         # Check rate limit
-        if len(self.user_rate_limits[user_id]) >= Config.RATE_LIMIT_REQUESTS:
+        if len(requests) >= Config.RATE_LIMIT_REQUESTS:
             return False
         
         # Add current request
-        self.user_rate_limits[user_id].append(now)
+        requests.append(now)
         return True
     
-    def add_conversation_entry(self, user_id: int, user_message: str, bot_response: str, user_name: str = None):
+    async def add_conversation_entry(self, user_id: int, user_message: str, bot_response: str, user_name: str = None):
         """Add a conversation entry for a user"""
-        if user_id not in self.conversations:
-            self.conversations[user_id] = []
+        history = await self._history(user_id)
         
         entry = {
-            'timestamp': datetime.now().isoformat(),
+            'timestamp': self._now(),
             'user_message': user_message,
             'bot_response': bot_response
         }
-        
-        self.conversations[user_id].append(entry)
-        
-        # Maintain conversation history limit
-        if len(self.conversations[user_id]) > Config.MAX_CONVERSATION_HISTORY:
-            self.conversations[user_id] = self.conversations[user_id][-Config.MAX_CONVERSATION_HISTORY:]
+        history.append(entry)
+        self.store.record(user_id, entry)
         
         # Update user profile
         self.update_user_profile(user_id, user_name)
     
-    def get_conversation_history(self, user_id: int) -> List[Dict[str, str]]:
+    async def get_conversation_history(self, user_id: int) -> deque:
         """Get conversation history for a user"""
-        return self.conversations.get(user_id, [])
+        return await self._history(user_id)
+    
+    async def get_prompt_history(self, user_id: int) -> Sequence[Dict[str, Any]]:
+        """Get the turns that aren't covered by the user's conversation summary"""
+        history = await self._history(user_id)
+        profile = self.user_profiles.get(user_id)
+        summary = profile.get('summary') if profile else None
+        if summary is None:
+            # Already bounded by the deque's maxlen, so no copy is needed
+            return history
+        
+        # Unsummarized turns are a suffix of the history; walk back from the newest
+        start = len(history)
+        while start and history[start - 1]['timestamp'] > summary['upto']:
+            start -= 1
+        return list(islice(history, start, None))
+    
+    async def set_summary(self, user_id: int, text: str, upto: float):
+        """Record a running summary of a user's conversation up to a turn's timestamp"""
+        # The history may have been cleared while the summary was being written
+        history = await self._history(user_id)
+        if not history or history[0]['timestamp'] > upto:
+            return
+        profile = self.user_profiles.get(user_id)
+        if profile is None:
+            return
+        
+        summary = profile.get('summary')
+        if summary is None:
+            # The opening turn stays in prompts verbatim
+            summary = profile['summary'] = {'first_turn': history[0]}
+        summary['text'] = text
+        summary['upto'] = upto
     
     def clear_conversation_history(self, user_id: int):
         """Clear conversation history for a user"""
-        if user_id in self.conversations:
-            del self.conversations[user_id]
+        # Cache an empty history so reads can't see rows the pending delete will remove
+        self.conversations[user_id] = deque(maxlen=Config.MAX_CONVERSATION_HISTORY)
+        self.store.delete(user_id)
         if user_id in self.user_profiles:
             # Keep memories but clear conversation-specific data
             profile = self.user_profiles[user_id]
+            now = self._now()
             self.user_profiles[user_id] = {
-                'memories': profile.get('memories', []),
+                'memories': profile.get('memories') or deque(maxlen=Config.MAX_USER_MEMORIES),
+                '_memory_index': profile.get('_memory_index', set()),
+                '_by_type': profile.get('_by_type', {}),
                 'name': profile.get('name'),
                 'created_at': profile.get('created_at'),
-                'last_interaction': datetime.now().isoformat()
+                'last_interaction': now
             }
+            self._touch(user_id, now)
     
     def update_user_profile(self, user_id: int, user_name: str = None):
         """Update user profile information"""
+        now = self._now()
         if user_id not in self.user_profiles:
             self.user_profiles[user_id] = {
-                'created_at': datetime.now().isoformat(),
-                'memories': [],
+                'created_at': now,
+                'memories': deque(maxlen=Config.MAX_USER_MEMORIES),
+                '_memory_index': set(),
+                '_by_type': {},
                 'name': user_name,
                 'total_messages': 0
             }
         
         profile = self.user_profiles[user_id]
-        profile['last_interaction'] = datetime.now().isoformat()
+        profile['last_interaction'] = now
         profile['total_messages'] = profile.get('total_messages', 0) + 1
+        self._touch(user_id, now)
         
         if user_name and not profile.get('name'):
             profile['name'] = user_name
     
-    def add_memories(self, user_id: int, memories: List[Dict[str, str]]):
-        """Add memories for a user"""
+    def ensure_user_profile(self, user_id: int, user_name: str = None):
+        """Update a user's profile unless it was already touched within the last second"""
+        # Repeated /start from the same user only needs one write
+        profile = self.user_profiles.get(user_id)
+        if profile is not None and self._now() - profile.get('last_interaction', 0.0) < 1.0:
+            return
+        self.update_user_profile(user_id, user_name)
+    
+    def _touch(self, user_id: int, timestamp: float):
+        """Record a user's latest interaction in the inactivity heap"""
+        heapq.heappush(self._lru_heap, (timestamp, user_id))
+        
+        # Every interaction leaves an entry behind, so compact once stale ones dominate.
+        # Rebuilt from profiles, not the history LRU, so evicted users still expire
+        if len(self._lru_heap) > 2 * len(self.user_profiles) + 64:
+            self._lru_heap = [
+                (profile.get('last_interaction', 0.0), uid)
+                for uid, profile in self.user_profiles.items()
+            ]
+            if user_id not in self.user_profiles:
+                self._lru_heap.append((timestamp, user_id))
+            heapq.heapify(self._lru_heap)
+    
+    def add_memories(self,
+                     user_id: int,
+                     memories: List[Dict[str, str]],
+                     embeddings: Optional[Sequence[np.ndarray]] = None):
+        """Add memories for a user, with optional unit-length content embeddings"""
+        now = self._now()
         if user_id not in self.user_profiles:
             self.user_profiles[user_id] = {
-                'created_at': datetime.now().isoformat(),
-                'memories': [],
+                'created_at': now,
+                'memories': deque(maxlen=Config.MAX_USER_MEMORIES),
+                '_memory_index': set(),
+                '_by_type': {},
                 'total_messages': 0
             }
         
         profile = self.user_profiles[user_id]
+        profile_memories = profile['memories']
+        memory_index = profile['_memory_index']
+        by_type = profile['_by_type']
         
-        for memory in memories:
+        for i, memory in enumerate(memories):
             # Add timestamp to memory
             memory_entry = {
                 'type': memory['type'],
                 'content': memory['content'],
-                'timestamp': datetime.now().isoformat()
+                'timestamp': now
             }
+            if embeddings is not None:
+                # Stored at half precision; scoring upcasts once per matrix rebuild
+                memory_entry['_embedding'] = np.asarray(embeddings[i], dtype=np.float16)
             
             # Check for duplicate memories
-            existing_contents = [m['content'].lower() for m in profile['memories']]
-            if memory['content'].lower() not in existing_contents:
-                profile['memories'].append(memory_entry)
+            key = memory['content'].lower()
+            if key not in memory_index:
+                # Appending to a full deque evicts the oldest memory
+                if len(profile_memories) == profile_memories.maxlen:
+                    self._forget_memory(profile, profile_memories[0])
+                memory_index.add(key)
+                profile_memories.append(memory_entry)
+                
+                # Keep memories grouped by type for display
+                bucket = by_type.get(memory_entry['type'])
+                if bucket is None:
+                    bucket = by_type[memory_entry['type']] = deque(maxlen=Config.MAX_USER_MEMORIES)
+                bucket.append(memory_entry['content'])
+                profile['_embedding_matrix'] = None
+    
+    def get_relevant_memories(self, user_id: int, query: np.ndarray, k: int) -> Optional[List[Dict[str, Any]]]:
+        """Get the k memories most similar to a unit-length query embedding
         
-        # Maintain memory limit
-        if len(profile['memories']) > Config.MAX_USER_MEMORIES:
-            profile['memories'] = profile['memories'][-Config.MAX_USER_MEMORIES:]
+        Returns them in the order they were saved, or None if the user has
+        no embedded memories.
+        """
+        profile = self.user_profiles.get(user_id)
+        if not profile:
+            return None
+        
+        # Stack the embeddings into one matrix, rebuilt only after memories change
+        cached = profile.get('_embedding_matrix')
+        if cached is None:
+            rows = [m for m in profile['memories'] if '_embedding' in m]
+            if not rows:
+                return None
+            matrix = np.stack([m['_embedding'] for m in rows]).astype(np.float32)
+            cached = profile['_embedding_matrix'] = (rows, matrix)
+        
+        rows, matrix = cached
+        if len(rows) <= k:
+            return list(rows)
+        
+        scores = matrix @ query
+        top = np.sort(np.argpartition(-scores, k)[:k])
+        return [rows[i] for i in top]
     
     def get_user_profile(self, user_id: int) -> Optional[Dict[str, Any]]:
         """Get user profile"""
         return self.user_profiles.get(user_id)
     
-    def get_user_memories(self, user_id: int) -> List[Dict[str, str]]:
+    def get_user_memories(self, user_id: int) -> deque:
         """Get user memories"""
         profile = self.user_profiles.get(user_id)
         if profile:
-            return profile.get('memories', [])
-        return []
+            return profile.get('memories') or deque()
+        return deque()
     
     def format_profile_summary(self, user_id: int) -> str:
         """Format user profile for display"""
@@ -137,106 +330,87 @@ class ConversationManager:
         
         name = profile.get('name', 'gorgeous')
         total_messages = profile.get('total_messages', 0)
-        memory_count = len(profile.get('memories', []))
+        memories = profile.get('memories') or ()
         
         # Get recent memories by type
-        memories = profile.get('memories', [])
-        memory_summary = {}
-        
-        for memory in memories[-10:]:  # Last 10 memories
-            mem_type = memory['type']
-            if mem_type not in memory_summary:
-                memory_summary[mem_type] = []
-            memory_summary[mem_type].append(memory['content'])
-        
-        summary = f"What I know about you, {name}... 😘\n\n"
-        summary += f"💖 We've shared {total_messages} messages together\n"
-        summary += f"🌙 I've collected {memory_count} precious memories of you\n\n"
+        memory_summary = defaultdict(list)
+        for memory in islice(memories, max(0, len(memories) - 10), None):  # Last 10 memories
+            memory_summary[memory['type']].append(memory['content'])
+        
+        parts = [
+            f"What I know about you, {name}... 😘\n\n",
+            f"💖 We've shared {total_messages} messages together\n",
+            f"🌙 I've collected {len(memories)} precious memories of you\n\n",
+        ]
         
         if memory_summary:
-            summary += "Here's what makes you special to me:\n"
-            
-            emoji_map = {
-                'interest': '✨', 'goal': '🎯', 'achievement': '🏆', 
-                'preference': '💫', 'desire': '💖', 'fantasy': '🌙',
-                'secret': '🔐', 'passion': '🔥', 'weakness': '💋'
-            }
-            
+            parts.append("Here's what makes you special to me:\n")
             for mem_type, contents in memory_summary.items():
-                emoji = emoji_map.get(mem_type, '💎')
-                summary += f"{emoji} **{mem_type.title()}**: {', '.join(contents[:3])}\n"
+                emoji = _PROFILE_EMOJI.get(mem_type, '💎')
+                parts.append(f"{emoji} **{mem_type.title()}**: {', '.join(contents[:3])}\n")
         
-        return summary
+        return ''.join(parts)
     
     def format_memories_display(self, user_id: int) -> str:
         """Format memories for display"""
-        memories = self.get_user_memories(user_id)
-        if not memories:
+        profile = self.get_user_profile(user_id)
+        if not profile or not profile.get('memories'):
             return Config.NO_MEMORIES
         
-        result = "All the little things I remember about you... 💋\n\n"
-        
-        # Group memories by type
-        memory_groups = {}
-        for memory in memories:
-            mem_type = memory['type']
-            if mem_type not in memory_groups:
-                memory_groups[mem_type] = []
-            memory_groups[mem_type].append(memory['content'])
-        
-        emoji_map = {
-            'interest': '✨ Interests', 'goal': '🎯 Goals', 'achievement': '🏆 Achievements',
-            'preference': '💫 Preferences', 'desire': '💖 Desires', 'fantasy': '🌙 Fantasies',
-            'secret': '🔐 Secrets', 'passion': '🔥 Passions', 'weakness': '💋 Weaknesses'
-        }
-        
-        for mem_type, contents in memory_groups.items():
-            display_name = emoji_map.get(mem_type, f'💎 {mem_type.title()}')
-            result += f"**{display_name}:**\n"
+        # Memories are already grouped by type as they're added
+        parts = ["All the little things I remember about you... 💋\n\n"]
+        for mem_type, contents in profile['_by_type'].items():
+            display_name = _MEMORY_EMOJI.get(mem_type) or f'💎 {mem_type.title()}'
+            parts.append(f"**{display_name}:**\n")
             for content in contents:
-                result += f"• {content}\n"
-            result += "\n"
+                parts.append(f"• {content}\n")
+            parts.append("\n")
         
-        return result
+        return ''.join(parts)
     
-    def cleanup_old_conversations(self):
+    async def cleanup_old_conversations(self):
         """Clean up old conversations (called periodically)"""
-        cutoff_time = datetime.now() - timedelta(hours=Config.CONVERSATION_CLEANUP_HOURS)
-        
-        users_to_cleanup = []
-        for user_id, profile in self.user_profiles.items():
-            last_interaction = datetime.fromisoformat(profile.get('last_interaction', '2000-01-01T00:00:00'))
-            if last_interaction < cutoff_time:
-                users_to_cleanup.append(user_id)
+        cutoff_time = self._now() - Config.CONVERSATION_CLEANUP_HOURS * 3600
+        
+        cleaned = 0
+        popped = 0
+        while self._lru_heap and self._lru_heap[0][0] < cutoff_time:
+            last_interaction, user_id = heapq.heappop(self._lru_heap)
+            profile = self.user_profiles.get(user_id)
+            # Otherwise a stale entry, the user has interacted since
+            if profile is not None and profile.get('last_interaction') == last_interaction:
+                if user_id in self.conversations:
+                    del self.conversations[user_id]
+                    cleaned += 1
+                # The summary describes the conversation being dropped
+                profile.pop('summary', None)
+                # Keep user profiles but might want to mark them as inactive
+            
+            # Yield to message handlers between chunks of work. They may compact
+            # the heap meanwhile, so the loop condition re-checks it before popping
+            popped += 1
+            if popped % Config.CLEANUP_CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
         
-        for user_id in users_to_cleanup:
-            if user_id in self.conversations:
-                del self.conversations[user_id]
-            # Keep user profiles but might want to mark them as inactive
+        # Also covers users whose profiles didn't survive a restart
+        self.store.delete_inactive(cutoff_time)
         
-        logger.info(f"Cleaned up conversations for {len(users_to_cleanup)} inactive users")
+        logger.info("Cleaned up conversations for %s inactive users", cleaned)
     
-    def cleanup_old_memories(self):
+    async def cleanup_old_memories(self):
         """Clean up old memories for all users"""
-        memory_cleanup_threshold = datetime.now() - timedelta(days=7)  # 7 days
+        memory_cleanup_threshold = self._now() - 7 * 86400  # 7 days
         
-        for user_id, profile in self.user_profiles.items():
+        # Iterate over a snapshot, since handlers may add profiles while we yield
+        for i, (user_id, profile) in enumerate(list(self.user_profiles.items()), 1):
+            if i % Config.CLEANUP_CHUNK_SIZE == 0:
+                await asyncio.sleep(0)
+            
             if 'memories' in profile:
                 # Keep only memories from the last 7 days
-                old_memories = profile['memories']
-                new_memories = [
-                    memory for memory in old_memories 
-                    if datetime.fromisoformat(memory.get('timestamp', '2000-01-01T00:00:00')) > memory_cleanup_threshold
-                ]
-                
-                # Also limit to maximum number of memories
-                if len(new_memories) > Config.MAX_USER_MEMORIES:
-                    new_memories = new_memories[-Config.MAX_USER_MEMORIES:]
-                
-                profile['memories'] = new_memories
-                
-                if len(old_memories) != len(new_memories):
-                    logger.info(f"Cleaned up {len(old_memories) - len(new_memories)} old memories for user {user_id}")
+                removed = self._expire_memories(profile, memory_cleanup_threshold)
+                if removed:
+                    logger.info("Cleaned up %s old memories for user %s", removed, user_id)
     
     def auto_cleanup_memories_for_user(self, user_id: int):
         """Auto cleanup memories for a specific user when they exceed limits"""
@@ -247,20 +421,8 @@ class ConversationManager:
         if 'memories' not in profile:
             return
         
-        memories = profile['memories']
-        
-        # If we have too many memories, keep only the most recent ones
-        if len(memories) > Config.MAX_USER_MEMORIES:
-            profile['memories'] = memories[-Config.MAX_USER_MEMORIES:]
-            logger.info(f"Auto-cleaned memories for user {user_id}: kept {Config.MAX_USER_MEMORIES} most recent")
-        
-        # Remove very old memories (older than 30 days)
-        old_threshold = datetime.now() - timedelta(days=30)
-        old_count = len(memories)
-        profile['memories'] = [
-            memory for memory in memories 
-            if datetime.fromisoformat(memory.get('timestamp', datetime.now().isoformat())) > old_threshold
-        ]
-        
-        if len(profile['memories']) != old_count:
-            logger.info(f"Removed {old_count - len(profile['memories'])} very old memories for user {user_id}")
+        # The memory deque already enforces MAX_USER_MEMORIES;
+        # remove very old memories (older than 30 days)
+        removed = self._expire_memories(profile, self._now() - 30 * 86400)
+        if removed:
+            logger.info("Removed %s very old memories for user %s", removed, user_id)
@@ -0,0 +1,148 @@
+"""SQLite persistence for Miss Lisa Bot conversations"""
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    uid INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    user_msg TEXT NOT NULL,
+    bot_msg TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_uid_ts ON conversations (uid, ts DESC);
+"""
+
+_INSERT = "INSERT INTO conversations (uid, ts, user_msg, bot_msg) VALUES (?, ?, ?, ?)"
+_DELETE_USER = "DELETE FROM conversations WHERE uid = ?"
+_DELETE_INACTIVE = """
+DELETE FROM conversations WHERE uid IN (
+    SELECT uid FROM conversations GROUP BY uid HAVING MAX(ts) < ?
+)
+"""
+# Keep at most MAX_CONVERSATION_HISTORY rows per user, matching the in-memory limit
+_TRIM_USER = """
+DELETE FROM conversations WHERE uid = ? AND ts < (
+    SELECT ts FROM conversations WHERE uid = ? ORDER BY ts DESC LIMIT 1 OFFSET ?
+)
+"""
+_SELECT_RECENT = """
+SELECT ts, user_msg, bot_msg FROM conversations WHERE uid = ? ORDER BY ts DESC LIMIT ?
+"""
+
+class ConversationStore:
+    """Conversation history in SQLite with write-behind batching
+
+    Writes are queued and committed by a single background task, up to
+    DB_WRITE_BATCH_SIZE operations per transaction. Reads are only issued
+    on an in-memory cache miss, on a worker thread.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Reads and writes each have their own connection, used from worker threads
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader_lock = threading.Lock()
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.executescript(_SCHEMA)
+        self._write_q: asyncio.Queue = asyncio.Queue()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background writer task"""
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._run_writer())
+
+    async def close(self):
+        """Flush pending writes and close the database"""
+        if self._writer_task is not None:
+            # The writer commits everything queued ahead of the sentinel, then exits
+            self._write_q.put_nowait(None)
+            await self._writer_task
+            self._writer_task = None
+        else:
+            pending = []
+            while not self._write_q.empty():
+                pending.append(self._write_q.get_nowait())
+            if pending:
+                self._commit(pending)
+
+        self._reader.close()
+        self._writer.close()
+
+    async def load(self, user_id: int, limit: int) -> List[Dict[str, Any]]:
+        """Load a user's most recent conversation entries, oldest first"""
+        rows = await asyncio.to_thread(self._select_recent, user_id, limit)
+        return [
+            {'timestamp': ts, 'user_message': user_msg, 'bot_response': bot_msg}
+            for ts, user_msg, bot_msg in reversed(rows)
+        ]
+
+    def _select_recent(self, user_id: int, limit: int) -> List[Tuple[float, str, str]]:
+        """Read a user's most recent rows, newest first"""
+        with self._reader_lock:
+            return self._reader.execute(_SELECT_RECENT, (user_id, limit)).fetchall()
+
+    def record(self, user_id: int, entry: Dict[str, Any]):
+        """Queue a conversation entry for writing"""
+        self._write_q.put_nowait((_INSERT, (
+            user_id, entry['timestamp'], entry['user_message'], entry['bot_response']
+        )))
+
+    def delete(self, user_id: int):
+        """Queue deletion of a user's conversation history"""
+        self._write_q.put_nowait((_DELETE_USER, (user_id,)))
+
+    def delete_inactive(self, cutoff: float):
+        """Queue deletion of conversations whose latest entry is older than the cutoff"""
+        self._write_q.put_nowait((_DELETE_INACTIVE, (cutoff,)))
+
+    async def _run_writer(self):
+        """Commit queued writes in batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            op = await self._write_q.get()
+            stopping = op is None
+            batch = [] if stopping else [op]
+            deadline = loop.time() + Config.DB_WRITE_BATCH_INTERVAL
+
+            while not stopping and len(batch) < Config.DB_WRITE_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    op = await asyncio.wait_for(self._write_q.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if op is None:
+                    stopping = True
+                else:
+                    batch.append(op)
+
+            if batch:
+                try:
+                    await asyncio.to_thread(self._commit, batch)
+                except Exception as e:
+                    logger.error("Error writing %s conversation updates: %s", len(batch), e)
+
+            if stopping:
+                return
+
+    def _commit(self, batch: List[Tuple[str, tuple]]):
+        """Apply a batch of writes in one transaction"""
+        inserted_users = set()
+        with self._writer:
+            for sql, params in batch:
+                self._writer.execute(sql, params)
+                if sql is _INSERT:
+                    inserted_users.add(params[0])
+
+            for user_id in inserted_users:
+                self._writer.execute(_TRIM_USER, (user_id, user_id, Config.MAX_CONVERSATION_HISTORY - 1))
@@ -1,151 +1,746 @@
 """Google Gemini AI client for Miss Lisa Bot"""
+import asyncio
+import hashlib
 import logging
 import os
-from typing import List, Dict, Any, Optional
+import re
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import AsyncIterator, List, Dict, Any, Literal, Optional, Sequence, Tuple
+
+import httpx
+import numpy as np
+import orjson
 from google import genai
 from google.genai import types
+from typing_extensions import TypedDict
 from config import Config
+from semantic_cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+# Response schemas, so Gemini returns already-validated JSON
+class Memory(TypedDict):
+    type: Literal['interest', 'goal', 'achievement', 'preference', 'desire', 'fantasy', 'secret', 'passion', 'weakness']
+    content: str
+
+class ReplyWithMemories(TypedDict):
+    reply: str
+    memories: list[Memory]
+
+class ExtractionResult(TypedDict):
+    id: str
+    memories: list[Memory]
+
+# Prompt templates; the per-request text is filled in with str.format
+_REPLY_WITH_MEMORIES_INSTRUCTIONS = """Reply to the message in character. Also note any personal information, preferences, interests, goals, or emotional details from the message that should be remembered about the user, in these categories only: interest, goal, achievement, preference, desire, fantasy, secret, passion, weakness
+
+Only remember clear, specific details. Use an empty memories array if nothing significant to remember."""
+
+_MEMORY_PROMPT = """Analyze this conversation and extract any personal information, preferences, interests, goals, or emotional details that should be remembered about the user. 
+
+User message: "{message}"
+My response: "{response}"
+
+Extract memories in these categories only: interest, goal, achievement, preference, desire, fantasy, secret, passion, weakness
+
+Only extract clear, specific details. Return an empty array if nothing significant to remember."""
+
+_BATCH_MEMORY_PROMPT = """Analyze each of these turns from one user's conversation and extract any personal information, preferences, interests, goals, or emotional details that should be remembered about the user. 
+
+Turns: {conversations}
+
+Extract memories in these categories only: interest, goal, achievement, preference, desire, fantasy, secret, passion, weakness
+
+Return one result per turn, with its id. Only extract clear, specific details. Use an empty memories array if nothing significant to remember."""
+
+_SUMMARY_PROMPT = """Update the running summary of a conversation between a user and Miss Lisa with the new turns below. Keep the topics, goals, and anything the user shared that later replies may refer to. Write at most a short paragraph.
+
+Summary so far: {summary}
+
+New turns:
+{turns}"""
+
+# Messages that can't contain a memory, so extraction is skipped
+_SMALL_TALK_RE = re.compile(
+    r'^\s*(?:ok(?:ay)?|lol|haha|hi|hey|hello|bye|thanks?|thank you|yes|no|yep|nope|k|hm+|wow|nice|cool)[.!?\s]*$',
+    re.IGNORECASE
+)
+# Messages whose reply doesn't depend on the conversation, so a chat's recent reply can be reused
+_GREETING_RE = re.compile(
+    r'^\s*(?:hi+|hey+|hello|hiya|yo|gm|gn|good\s+(?:morning|night|evening)|goodnight|bye)[.!?\s]*$',
+    re.IGNORECASE
+)
+_CONTENT_WORD_RE = re.compile(r'[^\W\d_]{4,}|\d')
+_FILLER_WORDS = frozenset({
+    'okay', 'yeah', 'haha', 'hehe', 'lmao', 'good', 'well', 'just', 'that',
+    'this', 'what', 'with', 'have', 'your', 'very', 'much', 'nice', 'cool',
+    'sure', 'then', 'when', 'here', 'from', 'they', 'them', 'were', 'been',
+    'hello', 'thanks', 'thank', 'really', 'great', 'sounds', 'alright', 'about',
+    'there', 'these', 'those', 'would', 'could', 'should', 'which', 'where',
+    'their', 'maybe', 'sorry', 'never', 'always', 'right', 'sweet', 'night',
+    'morning', 'goodnight', 'darling', 'gorgeous', 'hahaha', 'hehehe'
+})
+
+# Fallback replies when Gemini returns no text
+_SHY_REPLY = "Something's making me shy right now... 😘 Let's try a different topic, gorgeous? 💖"
+_CARRIED_AWAY_REPLY = "Mmm, I had so much to say that I got carried away... 😘 Let me be more concise, darling 💖"
+
+def _memory_order(memory: Dict[str, Any]) -> Tuple[float, bytes]:
+    """Sort key giving identical memory sets identical prompt text"""
+    digest = hashlib.blake2b(memory['content'].encode(), digest_size=8).digest()
+    return memory.get('timestamp', 0.0), digest
+
 class GeminiClient:
     def __init__(self, api_key: str):
         self.api_key = api_key
-        self.client = genai.Client(api_key=api_key)
+        # An explicit transport keeps the SDK on httpx, pooling connections and
+        # multiplexing concurrent requests over HTTP/2
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=Config.GEMINI_MAX_CONNECTIONS,
+                max_keepalive_connections=Config.GEMINI_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=Config.GEMINI_KEEPALIVE_EXPIRY
+            )
+        )
+        self.client = genai.Client(
+            api_key=api_key,
+            http_options=types.HttpOptions(async_client_args={'transport': transport})
+        )
         self.model = Config.GEMINI_MODEL
+        # Bound once; these are called on every message
+        self._generate = self.client.aio.models.generate_content
+        self._embed_content = self.client.aio.models.embed_content
+        self._generate_stream = self.client.aio.models.generate_content_stream
+        # Request configs are fixed, so they're built and validated once
+        self._reply_config = types.GenerateContentConfig(
+            system_instruction=Config.SYSTEM_INSTRUCTIONS,
+            max_output_tokens=Config.MAX_RESPONSE_TOKENS,
+            temperature=Config.TEMPERATURE,
+            top_p=0.9,  # Nucleus sampling for more diverse responses
+            top_k=40    # Consider top 40 tokens
+        )
+        self._combined_config = self._reply_config.model_copy(update={
+            'response_mime_type': "application/json",
+            'response_schema': ReplyWithMemories,
+            'max_output_tokens': Config.MAX_RESPONSE_TOKENS + 200  # Room for the memories array
+        })
+        self._extract_config = types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=list[Memory],
+            max_output_tokens=200,
+            temperature=0.3  # Lower temperature for more consistent extraction
+        )
+        self._batch_extract_config = self._extract_config.model_copy(update={
+            'response_schema': list[ExtractionResult]
+        })
+        self._summary_config = types.GenerateContentConfig(
+            max_output_tokens=150,
+            temperature=0.2
+        )
+        self._embed_config = types.EmbedContentConfig(output_dimensionality=Config.EMBEDDING_DIMENSIONS)
+        # Caps in-flight Gemini calls at roughly one second's worth of the QPM quota
+        self._request_sem = asyncio.Semaphore(max(1, Config.GEMINI_QPM // 60))
+        self._semantic_cache = SemanticCache(
+            Config.SEMANTIC_CACHE_SIZE,
+            Config.EMBEDDING_DIMENSIONS,
+            Config.SEMANTIC_CACHE_THRESHOLD
+        )
+        # Per-chat replies to recent short messages: key -> (expiry, reply), least recent first
+        self._response_cache: OrderedDict[Tuple[int, str], Tuple[float, str]] = OrderedDict()
+        # Pending (user_id, message, response, future) extractions, sent to Gemini in batches
+        self._extract_q: asyncio.Queue = asyncio.Queue()
+        self._extract_task: Optional[asyncio.Task] = None
+        # Server-side caches of each chat's history: name, last cached turn's timestamp, expiry
+        self._history_caches: OrderedDict[int, Dict[str, Any]] = OrderedDict()
+        self._history_caches_pending: set[int] = set()
+        # Background tasks are referenced here so they aren't garbage collected
+        self._bg_tasks: set[asyncio.Task] = set()
+    
+    def _spawn(self, coro):
+        """Run a coroutine in the background, keeping a reference until it finishes"""
+        task = asyncio.create_task(coro)
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._bg_tasks.discard)
+    
+    @staticmethod
+    def _with_cache(config: types.GenerateContentConfig, cache_name: Optional[str]) -> types.GenerateContentConfig:
+        """Point a request config at a context cache, which already carries the system instruction"""
+        if cache_name is None:
+            return config
+        return config.model_copy(update={'cached_content': cache_name, 'system_instruction': None})
+    
+    async def embed(self, texts: List[str]) -> Optional[np.ndarray]:
+        """Embed texts as unit-length float32 rows, or None if embedding fails"""
+        try:
+            async with self._request_sem:
+                result = await self._embed_content(
+                    model=Config.EMBEDDING_MODEL,
+                    contents=texts,
+                    config=self._embed_config
+                )
+            vectors = np.asarray([e.values for e in result.embeddings], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            return vectors / norms
+        except Exception as e:
+            logger.warning("Error embedding text: %s", e)
+            return None
+    
+    async def _semantic_cache_key(self,
+                            message: str,
+                            conversation_history: List[Dict[str, str]] = None,
+                            user_profile: Dict[str, Any] = None):
+        """Embedding to cache this turn's reply under, or None if it isn't shareable
+        
+        Replies are shared across users, so only turns without history or
+        memories are cached; anything else depends on the user's context.
+        """
+        if conversation_history or (user_profile and user_profile.get('memories')):
+            return None
+        vectors = await self.embed([message])
+        return vectors[0] if vectors is not None else None
+    
+    @staticmethod
+    def _response_cache_key(chat_id: Optional[int], message: str) -> Optional[Tuple[int, str]]:
+        """Key for reusing this chat's reply to the same greeting, or None if it isn't cacheable
+        
+        Only greetings are cached: replies to short answers like "yes" or "why?"
+        depend on the previous turn, so reusing them would repeat stale answers.
+        """
+        if chat_id is None or not _GREETING_RE.match(message):
+            return None
+        return chat_id, " ".join(message.lower().rstrip('.!? ').split())
+    
+    def forget_chat(self, chat_id: int):
+        """Drop a chat's cached replies, e.g. after its history is cleared"""
+        for key in [key for key in self._response_cache if key[0] == chat_id]:
+            del self._response_cache[key]
+    
+    def _recent_reply(self, key: Optional[Tuple[int, str]]) -> Optional[str]:
+        """Look up an unexpired reply in the response cache"""
+        if key is None:
+            return None
+        cached = self._response_cache.get(key)
+        if cached is None:
+            return None
+        expires_at, reply = cached
+        if expires_at < time.monotonic():
+            del self._response_cache[key]
+            return None
+        self._response_cache.move_to_end(key)
+        return reply
+    
+    def _remember_reply(self, key: Optional[Tuple[int, str]], reply: str):
+        """Store a reply in the response cache, evicting the least recently used when full"""
+        if key is None:
+            return
+        self._response_cache[key] = (time.monotonic() + Config.RESPONSE_CACHE_TTL, reply)
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > Config.RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+    
+    def _cache_reply(self, key, reply: str, user_profile: Dict[str, Any] = None):
+        """Store a generated reply unless it is addressed to this user by name"""
+        name = user_profile.get('name') if user_profile else None
+        if name and name.lower() in reply.lower():
+            return
+        self._semantic_cache.store(key, reply)
+        
+    @staticmethod
+    def _history_contents(conversation_history: Sequence[Dict[str, Any]],
+                          summary: Optional[Dict[str, Any]] = None) -> List[types.Content]:
+        """Committed history as real user/model turns, oldest first
+        
+        With a summary, the turns it covers are replaced by the summary and
+        the conversation's opening turn.
+        """
+        contents = []
+        if summary:
+            first = summary['first_turn']
+            contents.append(types.Content(role="user", parts=[
+                types.Part(text=f"Summary of our conversation so far: {summary['text']}"),
+                types.Part(text=first['user_message'])
+            ]))
+            contents.append(types.Content(role="model", parts=[types.Part(text=first['bot_response'])]))
+        for entry in conversation_history:
+            contents.append(types.Content(role="user", parts=[types.Part(text=entry['user_message'])]))
+            contents.append(types.Content(role="model", parts=[types.Part(text=entry['bot_response'])]))
+        return contents
+    
+    def _cached_history(self,
+                        chat_id: Optional[int],
+                        conversation_history: Sequence[Dict[str, Any]],
+                        summary: Optional[Dict[str, Any]] = None) -> Tuple[Optional[str], Sequence[Dict[str, Any]]]:
+        """Find the history cache for a chat, and the turns it doesn't cover
+        
+        A cache stays usable while its last turn is still in the history, so
+        it may cover turns that have since slid out of the window. It is
+        rebuilt in the background once it expires or CONTEXT_CACHE_REFRESH_TURNS
+        turns have been added since. A new summary also means a new cache,
+        since the summary leads the cached contents.
+        """
+        if chat_id is None or not conversation_history:
+            return None, conversation_history
+        
+        summary_upto = summary['upto'] if summary else None
+        entry = self._history_caches.get(chat_id)
+        tail_start = None
+        if entry is not None and entry['summary_upto'] == summary_upto:
+            self._history_caches.move_to_end(chat_id)
+            for i in range(len(conversation_history) - 1, -1, -1):
+                if conversation_history[i]['timestamp'] == entry['last_timestamp']:
+                    tail_start = i + 1
+                    break
+        
+        usable = tail_start is not None and entry['expires_at'] > time.monotonic()
+        if (chat_id not in self._history_caches_pending and
+            len(conversation_history) >= Config.CONTEXT_CACHE_MIN_TURNS and
+            (not usable or len(conversation_history) - tail_start >= Config.CONTEXT_CACHE_REFRESH_TURNS)):
+            self._history_caches_pending.add(chat_id)
+            self._spawn(self._cache_history(
+                chat_id,
+                self._history_contents(conversation_history, summary),
+                conversation_history[-1]['timestamp'],
+                summary_upto
+            ))
+        
+        if not usable or entry['name'] is None:
+            return None, conversation_history
+        return entry['name'], list(islice(conversation_history, tail_start, None))
+    
+    async def _cache_history(self,
+                             chat_id: int,
+                             contents: List[types.Content],
+                             last_timestamp: float,
+                             summary_upto: Optional[float]):
+        """Cache a chat's history server-side, replacing its previous cache"""
+        name = None
+        try:
+            cached = await self.client.aio.caches.create(
+                model=self.model,
+                config=types.CreateCachedContentConfig(
+                    contents=contents,
+                    system_instruction=Config.SYSTEM_INSTRUCTIONS,
+                    ttl=f"{Config.CONTEXT_CACHE_TTL}s"
+                )
+            )
+            name = cached.name
+        except Exception as e:
+            # Usually the history is still below the model's minimum cacheable size;
+            # the failed attempt is remembered below so it isn't retried every turn
+            logger.debug("Could not cache history for chat %s: %s", chat_id, e)
+        finally:
+            self._history_caches_pending.discard(chat_id)
+        
+        old = self._history_caches.pop(chat_id, None)
+        self._history_caches[chat_id] = {
+            'name': name,
+            'last_timestamp': last_timestamp,
+            'summary_upto': summary_upto,
+            # Stop using the cache a minute early so in-flight requests don't outlive it
+            'expires_at': time.monotonic() + Config.CONTEXT_CACHE_TTL - 60
+        }
+        if len(self._history_caches) > Config.CONVERSATION_CACHE_USERS:
+            # Evicted caches expire on the server by themselves
+            self._history_caches.popitem(last=False)
+        
+        if old is not None and old['name'] is not None:
+            try:
+                await self.client.aio.caches.delete(name=old['name'])
+            except Exception as e:
+                logger.debug("Could not delete history cache %s: %s", old['name'], e)
+    
+    def _build_contents(self,
+                        message: str,
+                        conversation_history: List[Dict[str, str]] = None,
+                        user_profile: Dict[str, Any] = None,
+                        memories: Optional[Sequence[Dict[str, Any]]] = None,
+                        instructions: Optional[str] = None,
+                        cached_prefix: bool = False) -> List[types.Content]:
+        """Build the conversation contents for a Gemini request
+        
+        Past turns come first, in the order they happened, so consecutive
+        requests share a byte-identical prefix that Gemini can serve from its
+        prompt cache. Anything that changes per turn (memories, the new
+        message) goes in the final user turn.
+        
+        memories are the ones to mention, defaulting to the profile's most recent.
+        cached_prefix means the conversation summary is in a context cache
+        rather than these contents.
+        """
+        summary = user_profile.get('summary') if user_profile and not cached_prefix else None
+        contents = self._history_contents(conversation_history or (), summary)
+        
+        # Add user profile context if available
+        profile_context = []
+        if user_profile:
+            if memories is None:
+                recent = user_profile.get('memories') or ()
+                memories = list(islice(recent, max(0, len(recent) - Config.PROMPT_MEMORIES), None))
+            if memories:
+                # Memories saved together share a timestamp, so the content hash breaks ties
+                ordered = sorted(memories, key=_memory_order)
+                profile_context.append("Remember: " + ", ".join([mem['content'] for mem in ordered]))
+            
+            if user_profile.get('name'):
+                profile_context.append(f"Name: {user_profile['name']}")
+        
+        parts = []
+        if profile_context:
+            parts.append(types.Part(text="\n".join(profile_context)))
+        parts.append(types.Part(text=f"Message: {message}"))
+        if instructions:
+            parts.append(types.Part(text=instructions))
+        
+        contents.append(types.Content(role="user", parts=parts))
+        return contents
+    
+    @staticmethod
+    def _nonempty_memories(memories: Optional[List[Memory]]) -> List[Dict[str, str]]:
+        """Drop memories with blank content, which the schema can't rule out"""
+        return [memory for memory in memories or () if memory['content'].strip()]
+    
+    async def _prepare_reply(self,
+                             message: str,
+                             conversation_history: Optional[Sequence[Dict[str, Any]]],
+                             user_profile: Optional[Dict[str, Any]],
+                             memories: Optional[Sequence[Dict[str, Any]]],
+                             chat_id: Optional[int],
+                             instructions: Optional[str] = None):
+        """Look a reply up in the response caches, or prepare the request for generating one
+        
+        Returns (cached_reply, response_key, cache_key, cache_name, contents).
+        On a hit only cached_reply and the keys checked so far are set, so
+        cache_key is None when the hit came from the per-chat response cache.
+        Otherwise the keys are for _record_reply, and cache_name and contents
+        are for the request.
+        """
+        response_key = self._response_cache_key(chat_id, message)
+        cached = self._recent_reply(response_key)
+        if cached is not None:
+            return cached, response_key, None, None, None
+        
+        cache_key = await self._semantic_cache_key(message, conversation_history, user_profile)
+        if cache_key is not None:
+            cached = self._semantic_cache.lookup(cache_key)
+            if cached is not None:
+                return cached, response_key, cache_key, None, None
+        
+        cache_name, uncached_history = self._cached_history(
+            chat_id, conversation_history, user_profile.get('summary') if user_profile else None
+        )
+        contents = self._build_contents(message, uncached_history, user_profile, memories, instructions,
+                                        cached_prefix=cache_name is not None)
+        return None, response_key, cache_key, cache_name, contents
+    
+    def _record_reply(self,
+                      response_key: Optional[Tuple[int, str]],
+                      cache_key,
+                      reply: str,
+                      user_profile: Optional[Dict[str, Any]]):
+        """Store a generated reply in the response caches it was looked up in"""
+        self._remember_reply(response_key, reply)
+        if cache_key is not None:
+            self._cache_reply(cache_key, reply, user_profile)
+    
+    async def generate_response_with_memories(self,
+                                              message: str,
+                                              conversation_history: List[Dict[str, str]] = None,
+                                              user_profile: Dict[str, Any] = None,
+                                              memories: Optional[Sequence[Dict[str, Any]]] = None,
+                                              chat_id: Optional[int] = None) -> Optional[Tuple[str, Optional[List[Dict[str, str]]]]]:
+        """Generate a response and extract memories from the message in a single call
         
+        Returns None when the combined reply can't be used, in which case the
+        caller should fall back to generate_response and extract_memories.
+        Memories are None when the reply was served from the semantic cache,
+        and empty when it repeats this chat's reply to the same message.
+        With a chat_id, history is served from the chat's server-side cache
+        when one is available.
+        """
+        try:
+            cached, response_key, cache_key, cache_name, contents = await self._prepare_reply(
+                message, conversation_history, user_profile, memories, chat_id,
+                _REPLY_WITH_MEMORIES_INSTRUCTIONS
+            )
+            if cached is not None:
+                if cache_key is None:
+                    # The same message was just answered, so its memories are already saved
+                    return cached, []
+                # Memories weren't extracted on a semantic cache hit
+                return cached, None
+            
+            async with self._request_sem:
+                response = await self._generate(
+                    model=self.model,
+                    contents=contents,
+                    config=self._with_cache(self._combined_config, cache_name)
+                )
+            
+            # parsed is None when the output didn't match the schema, e.g. it was truncated
+            result = response.parsed
+            if not result or not result['reply'].strip():
+                return None
+            
+            reply = result['reply'].strip()
+            self._record_reply(response_key, cache_key, reply, user_profile)
+            return reply, self._nonempty_memories(result['memories'])
+            
+        except Exception as e:
+            logger.error("Error generating combined response: %s", e)
+            return None
+    
     async def generate_response(self, 
                               message: str, 
                               conversation_history: List[Dict[str, str]] = None,
-                              user_profile: Dict[str, Any] = None) -> str:
+                              user_profile: Dict[str, Any] = None,
+                              memories: Optional[Sequence[Dict[str, Any]]] = None,
+                              chat_id: Optional[int] = None) -> str:
         """Generate a response using Gemini AI with context"""
         try:
-            # Build context from conversation history
-            context_messages = []
-            
-            if conversation_history:
-                for entry in conversation_history[-4:]:  # Last 4 messages for context
-                    context_messages.append(f"User: {entry['user_message']}")
-                    context_messages.append(f"Miss Lisa: {entry['bot_response']}")
-            
-            # Add user profile context if available
-            profile_context = ""
-            if user_profile:
-                if user_profile.get('memories'):
-                    memories_text = ", ".join([f"{mem['content']}" 
-                                             for mem in user_profile['memories'][-3:]])  # Last 3 memories
-                    profile_context = f"\nRemember: {memories_text}"
-                
-                if user_profile.get('name'):
-                    profile_context += f"\nName: {user_profile['name']}"
-            
-            # Construct the full prompt
-            full_context = ""
-            if context_messages:
-                full_context += "\nRecent:\n" + "\n".join(context_messages[-4:])  # Last 2 exchanges
-            
-            full_context += profile_context
-            full_context += f"\n\nMessage: {message}"
+            cached, response_key, cache_key, cache_name, contents = await self._prepare_reply(
+                message, conversation_history, user_profile, memories, chat_id
+            )
+            if cached is not None:
+                return cached
             
             # Generate response using the new API
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[
-                    types.Content(
-                        role="user", 
-                        parts=[types.Part(text=full_context)]
-                    )
-                ],
-                config=types.GenerateContentConfig(
-                    system_instruction=Config.SYSTEM_INSTRUCTIONS,
-                    max_output_tokens=Config.MAX_RESPONSE_TOKENS,
-                    temperature=Config.TEMPERATURE,
-                    top_p=0.9,  # Nucleus sampling for more diverse responses
-                    top_k=40    # Consider top 40 tokens
+            async with self._request_sem:
+                response = await self._generate(
+                    model=self.model,
+                    contents=contents,
+                    config=self._with_cache(self._reply_config, cache_name)
                 )
-            )
             
             if response.text:
-                return response.text.strip()
-            else:
-                # Check if response was truncated due to MAX_TOKENS
-                if (hasattr(response, 'candidates') and response.candidates and 
-                    len(response.candidates) > 0 and 
-                    hasattr(response.candidates[0], 'finish_reason')):
-                    finish_reason = response.candidates[0].finish_reason
-                    logger.warning(f"Empty response from Gemini. Finish reason: {finish_reason}")
-                    
-                    if str(finish_reason) == 'MAX_TOKENS':
-                        # Try to get partial content if available
-                        candidate = response.candidates[0]
-                        if hasattr(candidate, 'content') and candidate.content and hasattr(candidate.content, 'parts'):
-                            for part in candidate.content.parts:
-                                if hasattr(part, 'text') and part.text:
-                                    logger.info("Retrieved partial response from truncated content")
-                                    return part.text.strip()
-                        return "Mmm, I had so much to say that I got carried away... 😘 Let me be more concise, darling 💖"
-                    else:
-                        return "Something's making me shy right now... 😘 Let's try a different topic, gorgeous? 💖"
-                else:
-                    logger.warning(f"Empty response from Gemini. Response object: {response}")
-                    return "Something's making me shy right now... 😘 Let's try a different topic, gorgeous? 💖"
+                reply = response.text.strip()
+                self._record_reply(response_key, cache_key, reply, user_profile)
+                return reply
+            
+            # Empty reply; if it was cut off at MAX_TOKENS, salvage any partial text
+            candidates = getattr(response, 'candidates', None) or ()
+            candidate = candidates[0] if candidates else None
+            if candidate is None:
+                logger.warning("Empty response from Gemini. Response object: %r", response)
+                return _SHY_REPLY
+            
+            finish_reason = getattr(candidate, 'finish_reason', None)
+            logger.warning("Empty response from Gemini. Finish reason: %s", finish_reason)
+            if finish_reason != types.FinishReason.MAX_TOKENS:
+                return _SHY_REPLY
+            
+            content = getattr(candidate, 'content', None)
+            for part in getattr(content, 'parts', None) or ():
+                text = getattr(part, 'text', None)
+                if text:
+                    logger.info("Retrieved partial response from truncated content")
+                    return text.strip()
+            return _CARRIED_AWAY_REPLY
                 
         except Exception as e:
-            logger.error(f"Error generating response: {e}")
+            logger.error("Error generating response: %s", e)
             return Config.ERROR_MESSAGES['api_error']
     
-    async def extract_memories(self, message: str, response: str) -> List[Dict[str, str]]:
-        """Extract potential memories from conversation"""
+    async def generate_response_stream(self,
+                                       message: str,
+                                       conversation_history: List[Dict[str, str]] = None,
+                                       user_profile: Dict[str, Any] = None,
+                                       memories: Optional[Sequence[Dict[str, Any]]] = None,
+                                       chat_id: Optional[int] = None) -> AsyncIterator[str]:
+        """Generate a response like generate_response, yielding text as it arrives
+        
+        Cached replies and fallback messages are yielded as a single chunk.
+        If the stream breaks after text was yielded, the error is raised so
+        the caller knows the reply is incomplete.
+        """
         try:
-            memory_prompt = f"""Analyze this conversation and extract any personal information, preferences, interests, goals, or emotional details that should be remembered about the user. 
-
-User message: "{message}"
-My response: "{response}"
-
-Extract memories in these categories only: interest, goal, achievement, preference, desire, fantasy, secret, passion, weakness
-
-Return JSON array of memories like: [{{"type": "interest", "content": "loves hiking"}}, {{"type": "preference", "content": "prefers tea over coffee"}}]
-
-Only extract clear, specific details. Return empty array [] if nothing significant to remember."""
+            cached, response_key, cache_key, cache_name, contents = await self._prepare_reply(
+                message, conversation_history, user_profile, memories, chat_id
+            )
+        except Exception as e:
+            logger.error("Error generating response: %s", e)
+            yield Config.ERROR_MESSAGES['api_error']
+            return
+        if cached is not None:
+            yield cached
+            return
+        
+        # Read on a separate task so the request slot isn't held while the caller handles chunks
+        queue: asyncio.Queue = asyncio.Queue()
+        pump = asyncio.create_task(self._pump_stream(contents, cache_name, queue))
+        chunks = []
+        try:
+            while (item := await queue.get()) is not None:
+                if isinstance(item, Exception):
+                    raise item
+                chunks.append(item)
+                yield item
+        except Exception as e:
+            logger.error("Error streaming response: %s", e)
+            if chunks:
+                raise
+            yield Config.ERROR_MESSAGES['api_error']
+            return
+        finally:
+            pump.cancel()
+        
+        reply = "".join(chunks).strip()
+        if not reply:
+            logger.warning("Empty streamed response from Gemini")
+            yield _SHY_REPLY
+            return
+        
+        self._record_reply(response_key, cache_key, reply, user_profile)
+    
+    async def _pump_stream(self, contents, cache_name: Optional[str], queue: asyncio.Queue):
+        """Read a streamed reply into a queue, ending with None or the error that stopped it"""
+        try:
+            async with self._request_sem:
+                stream = await self._generate_stream(
+                    model=self.model,
+                    contents=contents,
+                    config=self._with_cache(self._reply_config, cache_name)
+                )
+                async for chunk in stream:
+                    if chunk.text:
+                        queue.put_nowait(chunk.text)
+        except Exception as e:
+            queue.put_nowait(e)
+        else:
+            queue.put_nowait(None)
+    
+    async def summarize_history(self,
+                                previous_summary: Optional[str],
+                                conversation_history: Sequence[Dict[str, Any]]) -> Optional[str]:
+        """Fold conversation turns into a running summary, or None if summarizing fails"""
+        try:
+            turns = "\n".join([
+                f"User: {entry['user_message']}\nMiss Lisa: {entry['bot_response']}"
+                for entry in conversation_history
+            ])
+            summary_prompt = _SUMMARY_PROMPT.format(summary=previous_summary or "(none)", turns=turns)
             
-            memory_response = self.client.models.generate_content(
-                model=self.model,
-                contents=[
-                    types.Content(
-                        role="user",
-                        parts=[types.Part(text=memory_prompt)]
-                    )
-                ],
-                config=types.GenerateContentConfig(
-                    response_mime_type="application/json",
-                    max_output_tokens=200,
-                    temperature=0.3  # Lower temperature for more consistent extraction
+            async with self._request_sem:
+                response = await self._generate(
+                    model=self.model,
+                    contents=summary_prompt,
+                    config=self._summary_config
                 )
-            )
             
-            if memory_response.text:
-                import json
-                try:
-                    memories = json.loads(memory_response.text)
-                    if isinstance(memories, list):
-                        # Validate memory format
-                        valid_memories = []
-                        valid_types = {'interest', 'goal', 'achievement', 'preference', 'desire', 'fantasy', 'secret', 'passion', 'weakness'}
-                        
-                        for memory in memories:
-                            if (isinstance(memory, dict) and 
-                                'type' in memory and 
-                                'content' in memory and
-                                memory['type'] in valid_types and
-                                len(memory['content'].strip()) > 0):
-                                valid_memories.append(memory)
-                        
-                        return valid_memories
-                except json.JSONDecodeError:
-                    logger.warning("Failed to parse memories JSON")
+            return response.text.strip() if response.text else None
             
+        except Exception as e:
+            logger.error("Error summarizing conversation: %s", e)
+            return None
+    
+    async def extract_memories(self, message: str, response: str, user_id: Optional[int] = None) -> List[Dict[str, str]]:
+        """Extract potential memories from conversation
+        
+        A user's requests arriving within MEMORY_BATCH_INTERVAL of each other
+        share one Gemini call; different users are never batched together, so
+        one user's details can't be attributed to another. Small talk is
+        skipped without a call.
+        """
+        if not self._may_have_memories(message):
             return []
+        
+        if self._extract_task is None:
+            self._extract_task = asyncio.create_task(self._run_extractions())
+        
+        future = asyncio.get_running_loop().create_future()
+        self._extract_q.put_nowait((user_id, message, response, future))
+        return await future
+    
+    @staticmethod
+    def _may_have_memories(message: str) -> bool:
+        """Cheap check for whether a message could contain anything worth remembering"""
+        if len(message.strip()) < Config.MIN_MEMORY_MESSAGE_LENGTH or _SMALL_TALK_RE.match(message):
+            return False
+        # Something to remember needs a number or at least one word with some substance
+        return any(
+            word.lower() not in _FILLER_WORDS for word in _CONTENT_WORD_RE.findall(message)
+        )
+    
+    async def _run_extractions(self):
+        """Collect queued extractions into batches and send each batch off"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._extract_q.get()]
+            deadline = loop.time() + Config.MEMORY_BATCH_INTERVAL
+            
+            while len(batch) < Config.MEMORY_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._extract_q.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Keep collecting the next batch while this one is in flight
+            self._spawn(self._extract_batch(batch))
+    
+    async def _extract_batch(self, batch: List[Tuple[Optional[int], str, str, asyncio.Future]]):
+        """Extract memories for a batch of conversations, one call per user, and resolve their futures"""
+        by_user: Dict[Any, List[Tuple[str, str, asyncio.Future]]] = {}
+        for user_id, message, response, future in batch:
+            # Extractions without a user can't be told apart, so each gets its own call
+            key = user_id if user_id is not None else id(future)
+            by_user.setdefault(key, []).append((message, response, future))
+        await asyncio.gather(*(self._extract_user_batch(items) for items in by_user.values()))
+    
+    async def _extract_user_batch(self, items: List[Tuple[str, str, asyncio.Future]]):
+        """Extract memories for one user's queued turns and resolve their futures"""
+        if len(items) == 1:
+            message, response, _ = items[0]
+            results = [await self._extract_one(message, response)]
+        else:
+            results = await self._extract_many([(message, response) for message, response, _ in items])
+        
+        for (_, _, future), memories in zip(items, results):
+            if not future.done():
+                future.set_result(memories)
+    
+    async def _extract_one(self, message: str, response: str) -> List[Dict[str, str]]:
+        """Extract memories from a single conversation"""
+        try:
+            memory_prompt = _MEMORY_PROMPT.format(message=message, response=response)
+            
+            async with self._request_sem:
+                memory_response = await self._generate(
+                    model=self.model,
+                    contents=memory_prompt,
+                    config=self._extract_config
+                )
+            
+            return self._nonempty_memories(memory_response.parsed)
             
         except Exception as e:
-            logger.error(f"Error extracting memories: {e}")
+            logger.error("Error extracting memories: %s", e)
             return []
+    
+    async def _extract_many(self, conversations: List[Tuple[str, str]]) -> List[List[Dict[str, str]]]:
+        """Extract memories from several turns of one user's conversation in one call"""
+        try:
+            items = [
+                {'id': f"r{i}", 'user': message, 'bot': response}
+                for i, (message, response) in enumerate(conversations, 1)
+            ]
+            memory_prompt = _BATCH_MEMORY_PROMPT.format(conversations=orjson.dumps(items).decode())
+            
+            async with self._request_sem:
+                memory_response = await self._generate(
+                    model=self.model,
+                    contents=memory_prompt,
+                    config=self._batch_extract_config.model_copy(update={'max_output_tokens': 200 * len(conversations)})
+                )
+            
+            by_id = {result['id']: result['memories'] for result in memory_response.parsed or ()}
+            return [self._nonempty_memories(by_id.get(item['id'])) for item in items]
+            
+        except Exception as e:
+            logger.error("Error extracting memories for %s turns: %s", len(conversations), e)
+            return [[] for _ in conversations]
@@ -0,0 +1,51 @@
+"""Embedding-keyed response cache for Miss Lisa Bot"""
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+class SemanticCache:
+    """LRU cache of replies keyed by message embeddings
+
+    Keys are unit-normalized embeddings stored as rows of one preallocated
+    matrix, so a lookup is a single matrix-vector product.
+    """
+
+    def __init__(self, capacity: int, dim: int, threshold: float):
+        self.capacity = capacity
+        self.threshold = threshold
+        self._keys = np.zeros((capacity, dim), dtype=np.float32)
+        self._replies: List[Optional[str]] = [None] * capacity
+        # Occupied slots, least recently used first
+        self._lru: OrderedDict[int, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def lookup(self, query: np.ndarray) -> Optional[str]:
+        """Return the cached reply most similar to the query, if close enough"""
+        if not self._lru:
+            return None
+
+        # Unused rows are zero, so they never clear the threshold
+        scores = self._keys @ query
+        slot = int(np.argmax(scores))
+        if scores[slot] < self.threshold:
+            return None
+
+        self._lru.move_to_end(slot)
+        return self._replies[slot]
+
+    def store(self, query: np.ndarray, reply: str):
+        """Cache a reply, evicting the least recently used one when full"""
+        if len(self._lru) < self.capacity:
+            slot = len(self._lru)
+        else:
+            slot, _ = self._lru.popitem(last=False)
+
+        self._keys[slot] = query
+        self._replies[slot] = reply
+        self._lru[slot] = None